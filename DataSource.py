@@ -3,34 +3,96 @@ from enum import Enum
 from pathlib import Path
 from urllib.request import urlopen
 from zipfile import ZipFile
-from shutil import copyfileobj, move, rmtree
-from tempfile import SpooledTemporaryFile
+from io import BytesIO
+import re
 from re import sub, findall
-import random
 from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import os
+import gc
+import mmap
+import numpy as np
+
+# line ids in the "['L194', 'L195', ...]" column of movie_conversations.txt
+_lineIdPattern = re.compile(r"L\d+")
 
 _dataDir = Path("data")
 if not _dataDir.exists():
     _dataDir.mkdir()
 
 
+def _readRows(path, numColumns, data=None):
+    # one decode for the whole file, then let str.split do the per line work in C
+    if data is not None:
+        data = data.decode(errors="ignore")
+    else:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                data = ""
+            else:
+                # decode straight out of the page cache instead of copying the file into a bytes object first
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    data = str(mapped, "utf-8", "ignore")
+    # rows are yielded one at a time and left unstripped, callers strip only the columns they use;
+    # malformed lines with too few columns are skipped
+    for line in data.split("\n"):
+        row = line.split("+++$+++", numColumns - 1)
+        if len(row) == numColumns:
+            yield row
+
+
+@contextmanager
+def _gcPaused():
+    # parsing allocates hundreds of thousands of long lived containers, which would otherwise trigger
+    # repeated full garbage collection passes that find nothing to free
+    wasEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if wasEnabled:
+            gc.enable()
+
+
 def writeToFile(path, prompt, response, filename="train"):
     if not path.exists():
         path.mkdir()
     for lines, extension in [(prompt, "enc"), (response, "dec")]:
-        with open(str(path / (filename + "." + extension)), "w") as f:
-            f.write("\n".join(lines))
+        with open(str(path / (filename + "." + extension)), "w", buffering=1 << 20) as f:
+            f.writelines(line + "\n" for line in lines)
 
 
 def makeTrainTest(*args, testPercent=0.1):
     l = len(args[0])
     for arg in args:
         assert l == len(arg)
-    testIndices = set(random.sample(range(l), round(l * testPercent)))
-    trainIndices = sorted(set(range(l)) - testIndices)
-    testIndices = sorted(testIndices)
-    return [[arg[i] for i in trainIndices] for arg in args], \
-           [[arg[i] for i in testIndices] for arg in args]
+    if not 0 <= testPercent <= 1:
+        # slicing the permutation would silently cap the test set, random.sample used to refuse this
+        raise ValueError("testPercent must be between 0 and 1, got {}".format(testPercent))
+    indices = np.random.default_rng().permutation(l)
+    testSize = round(l * testPercent)
+    testIndices, trainIndices = np.sort(indices[:testSize]), np.sort(indices[testSize:])
+    columns = []
+    for arg in args:
+        # filled element-wise so the strings are never coerced into a fixed width numpy dtype
+        column = np.empty(l, dtype=object)
+        column[:] = arg
+        columns.append(column)
+    return [column[trainIndices].tolist() for column in columns], \
+           [column[testIndices].tolist() for column in columns]
+
+
+def writeCharacterFiles(path, characters, names):
+    # every character gets its own directory, so their train / test files can be written concurrently
+    def writeCharacter(character, name):
+        train, test = makeTrainTest(*character)
+        writeToFile(path / name, train[0], train[1], "train")
+        writeToFile(path / name, test[0], test[1], "test")
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for future in [executor.submit(writeCharacter, *args) for args in zip(characters, names)]:
+            future.result()
 
 
 class _AbstractDataSource(ABC):
@@ -58,25 +120,43 @@ class _CornellMovieCorpus(_AbstractDataSource):
         self.movieLines = self.localPath / "movie_lines.txt"
         self.movieConversations = self.localPath / "movie_conversations.txt"
         self.movieMeta = self.localPath / "movie_characters_metadata.txt"
+        self.movieTitles = self.localPath / "movie_titles_metadata.txt"
+        # plain string paths, so the parsing code does not rebuild them from Path objects
+        self._movieLinesPath = os.fspath(self.movieLines)
+        self._movieConversationsPath = os.fspath(self.movieConversations)
+        self._movieMetaPath = os.fspath(self.movieMeta)
+        self._movieTitlesPath = os.fspath(self.movieTitles)
+        self._rawFiles = {}
         self.maybeDownload()
+        self._load()
 
-        with open(str(self.movieConversations), "r", errors="ignore") as f:
-            self.conversations = [findall(r"L\d+", line.split("+++$+++")[-1]) for line in f]
+    def _load(self):
+        # characterId -> (prompts, responses), only built once getCharacter is first called
+        self._byChar = None
+        with _gcPaused():
+            self._parse()
 
-        self._lineMap = {}
-        with open(str(self.movieLines), "r", errors="ignore") as f:
-            for line in f:
-                _line = line.split("+++$+++")
-                lineId = _line[0].strip()
-                # get rid of newlines and beginning spaces
-                self._lineMap[lineId] = _line[-1].strip()
+    def _readRows(self, path, numColumns):
+        # files that were just downloaded are parsed straight from memory, once
+        return _readRows(path, numColumns, self._rawFiles.pop(path, None))
 
-        self._charMap = {}
-        with open(str(self.movieMeta), errors="ignore") as f:
-            for line in f:
-                _line = line.split("+++$+++")
-                name = _line[1].strip().lower()
-                self._charMap[name] = _line[0].strip()
+    def _parse(self):
+        # every source file is scanned exactly once here, the lookup methods below only index these
+        self.conversations = [_lineIdPattern.findall(row[-1])
+                              for row in self._readRows(self._movieConversationsPath, 4)]
+
+        self._lineMap = {}
+        # the remaining columns of movie_lines.txt as flat lists, in file order
+        self._lineIds, self._lineCharacterIds, self._lineMovieIds, self._lineNames = [], [], [], []
+        for lineId, characterId, movieId, name, text in self._readRows(self._movieLinesPath, 5):
+            lineId = lineId.strip()
+            self._lineMap[lineId] = text.strip()
+            self._lineIds.append(lineId)
+            self._lineCharacterIds.append(characterId.strip())
+            self._lineMovieIds.append(movieId.strip())
+            self._lineNames.append(name.strip())
+
+        self._charMap = {row[1].strip().lower(): row[0].strip() for row in self._readRows(self._movieMetaPath, 6)}
 
         self._prevLineMap = {}
         for lineIds in self.conversations:
@@ -97,69 +177,64 @@ class _CornellMovieCorpus(_AbstractDataSource):
     def maybeDownload(self, force=False):
         if not self.localPath.exists() or force:
             rootZipDir = "cornell movie-dialogs corpus"
-            with urlopen(self._url) as response, SpooledTemporaryFile() as tmp:
-                copyfileobj(response, tmp)
-                with ZipFile(tmp) as zipTmp:
-                    infoList = zipTmp.infolist()
-                    for info in infoList:
-                        pathFile = Path(info.filename)
-                        if pathFile.parts[0] == rootZipDir and pathFile.stem != ".DS_Store":
-                            zipTmp.extract(info, self.localPath)
-            for p in self.localPath.joinpath(rootZipDir).iterdir():
-                move(str(p), str(self.localPath))
-            rmtree(str(self.localPath / rootZipDir))
+            # the ~10 MB zip is unpacked from memory, and the files we parse are kept around so that _parse
+            # does not have to read them back from disk
+            with urlopen(self._url) as response, ZipFile(BytesIO(response.read())) as zipTmp:
+                members = []
+                for info in zipTmp.infolist():
+                    pathFile = Path(info.filename)
+                    if pathFile.parts[0] == rootZipDir and len(pathFile.parts) > 1 \
+                            and pathFile.stem != ".DS_Store":
+                        # extract straight into localPath rather than into a nested rootZipDir
+                        info.filename = "/".join(pathFile.parts[1:]) + ("/" if info.is_dir() else "")
+                        members.append(info)
+                # extractall sanitizes the member names, so nothing can be written outside localPath
+                zipTmp.extractall(str(self.localPath), members)
+                for info in members:
+                    localFile = os.fspath(self.localPath / info.filename)
+                    if localFile in (self._movieLinesPath, self._movieConversationsPath, self._movieMetaPath):
+                        self._rawFiles[localFile] = zipTmp.read(info)
+            if force:
+                self._load()
 
     def getMostCommonCharacters(self, num):
-        with open(str(self.movieLines), errors="ignore") as f:
-            names = [line.split("+++$+++")[3].strip().lower() for line in f]
-        most_common = []
-        most_common.extend(Counter(names).most_common(num))
+        # count straight from the line index, without an intermediate list of every line's name
+        most_common = Counter(map(str.lower, self._lineNames)).most_common(num)
         return [self.getCharacter(characterName=character[0]) for character in most_common], \
                [character[0] for character in most_common]
 
     def getCharacter(self, characterId=None, characterName=None):
         characterId = characterId or self.characterToId(characterName)
-        prompt, response = [], []
-        with open(str(self.movieLines), "r", errors="ignore") as f:
-            for line in f:
-                _line = line.split("+++$+++")
-                lineId = _line[0].strip()
-                if _line[1].strip() == characterId and lineId in self._prevLineMap:
-                    prompt.append(self._lineMap[self._prevLineMap[lineId]])
-                    response.append(self._lineMap[lineId])
-        return prompt, response
+        if self._byChar is None:
+            # every line of a character that answers another line, in file order
+            self._byChar = {}
+            with _gcPaused():
+                for lineId, lineCharacterId in zip(self._lineIds, self._lineCharacterIds):
+                    if lineId in self._prevLineMap:
+                        prompt, response = self._byChar.setdefault(lineCharacterId, ([], []))
+                        prompt.append(self._lineMap[self._prevLineMap[lineId]])
+                        response.append(self._lineMap[lineId])
+        prompt, response = self._byChar.get(characterId, ([], []))
+        return list(prompt), list(response)
 
     def makeYearSubset(self, movieYear):
-        with open(str(self.localPath / "movie_titles_metadata.txt"), "r", errors="ignore") as f:
-            year = str(movieYear)
-            movie_ids = set()
-            for line in f:
-                if line.split("+++$+++")[2].strip()[:3] == year[:3]:
-                    movie_ids.add(line.split("+++$+++")[0].strip())
-        return movie_ids
+        decade = str(movieYear)[:3]
+        return {row[0].strip() for row in _readRows(self._movieTitlesPath, 6) if row[2].strip()[:3] == decade}
 
     def makeYearFiles(self, movieYear):
-        with open(str(self.localPath / "movie_lines.txt"), "r", errors="ignore") as f:
-            yearConversations = []
-            yearSubset = self.makeYearSubset(movieYear)
-            for line in f:
-                lineYear = line.split("+++$+++")[2].strip()
-                if lineYear in yearSubset:
-                    lineToAdd = line.split("+++$+++")[-1].strip()
-                    yearConversations.append(lineToAdd)
-        inputs = []
-        outputs = []
-        for i in range(len(yearConversations)):
-            if i % 2 == 0:  # if i is even, it is an input. if i is odd, it is an output
-                inputs.append(yearConversations[i])
-            else:
-                outputs.append(yearConversations[i])
-        return inputs, outputs
+        yearSubset = self.makeYearSubset(movieYear)
+        # filtered in file order, the even / odd pairing below depends on it
+        yearConversations = [self._lineMap[lineId] for lineId, movieId in zip(self._lineIds, self._lineMovieIds)
+                             if movieId in yearSubset]
+        # even lines are inputs, odd lines are outputs
+        return yearConversations[0::2], yearConversations[1::2]
 
     def getData(self):
-        prompt = [self._lineMap[self._prevLineMap[lineId]] for lineId in self._prevLineMap]
-        response = [self._lineMap[lineId] for lineId in self._prevLineMap]
-        return prompt, response
+        pairs = [(self._lineMap[prevLineId], self._lineMap[lineId]) for lineId, prevLineId in self._prevLineMap.items()]
+        if not pairs:
+            return [], []
+        prompt, response = zip(*pairs)
+        return list(prompt), list(response)
 
 
 class _UbuntuDialogCorpus(_AbstractDataSource):
@@ -217,10 +292,7 @@ if __name__ == "__main__":
     writeToFile(cornell.localPath / year, yearTest[0], yearTest[1], "test")
 
     """characters, names_ = cornell.getMostCommonCharacters(5)
-    for i,char in enumerate(characters):
-        train, test = makeTrainTest(*char)
-        writeToFile(cornell.localPath / names_[i], train[0], train[1], "train")
-        writeToFile(cornell.localPath / names_[i], test[0], test[1], "test")"""
+    writeCharacterFiles(cornell.localPath, characters, names_)"""
 
     # ubuntu = DataSource.UBUNTU_DIALOG_CORPUS.value()
     # uPrompt,uResponse = ubuntu.getData()
@@ -1,4 +1,4 @@
-import random
+import numpy as np
 
 ''' 
     1. Read from 'movie-lines.txt'
@@ -69,17 +69,24 @@ def gather_dataset(convs, id2line):
 '''
 def prepare_seq2seq_files(questions, answers, path='',TESTSET_SIZE = 30000):
     
+    # the permutation below would silently cap the test set, random.sample used to refuse this
+    if not 0 <= TESTSET_SIZE <= len(questions):
+        raise ValueError('TESTSET_SIZE (%d) must be between 0 and the number of questions (%d)'
+                         % (TESTSET_SIZE, len(questions)))
+
     # open files
-    train_enc = open(path + 'train.enc','w')
-    train_dec = open(path + 'train.dec','w')
-    test_enc  = open(path + 'test.enc', 'w')
-    test_dec  = open(path + 'test.dec', 'w')
+    train_enc = open(path + 'train.enc','w', buffering=1<<20)
+    train_dec = open(path + 'train.dec','w', buffering=1<<20)
+    test_enc  = open(path + 'test.enc', 'w', buffering=1<<20)
+    test_dec  = open(path + 'test.dec', 'w', buffering=1<<20)
 
     # choose 30,000 (TESTSET_SIZE) items to put into testset
-    test_ids = random.sample([i for i in range(len(questions))],TESTSET_SIZE)
+    is_test = np.zeros(len(questions), dtype=bool)
+    is_test[np.random.default_rng().permutation(len(questions))[:TESTSET_SIZE]] = True
+    is_test = is_test.tolist()
 
     for i in range(len(questions)):
-        if i in test_ids:
+        if is_test[i]:
             test_enc.write(questions[i]+'\n')
             test_dec.write(answers[i]+ '\n' )
         else: